@@ -22,7 +22,10 @@ import sys
 import re
 import math
 import logging
+from bisect import bisect_left, bisect_right
 from enum import Enum, auto
+from functools import lru_cache
+from types import SimpleNamespace
 from typing import List, Dict, Tuple, Union
 
 import hal
@@ -75,6 +78,8 @@ except:
 # assumption is MM's is the base unit of reference.
 PLASMADB = None
 DEBUG_COMMENTS = False
+# number of gcode lines collected before being written to stdout
+OUTPUT_BATCH_LINES = 1024
 
 G_MODAL_GROUPS = {
     1: ('G0','G1','G2','G3','G33','G38.n','G73','G76','G80','G81',\
@@ -97,6 +102,50 @@ M_MODAL_GROUPS = {
     7: ('M3','M4','M5'),
     9: ('M48','M49')}
 
+# group 1 motion codes that set the XY position used to find holes
+_MOTION_CODES = frozenset(('G0', 'G1', 'G2', 'G3'))
+
+
+@lru_cache(maxsize=64)
+def _cached_cut_by_id(tool):
+    # cut process lookups are repeated for every tool change line, so
+    # keep the DB results. Cleared whenever PLASMADB is (re)connected.
+    return PLASMADB.cut_by_id(tool)
+
+
+# Precompiled regex patterns used when parsing each line of gcode
+_MULTI_CODES_RE = re.compile(r"G\d+|T\s*\d+|M\d+")
+_TOOL_M6_RE = re.compile(r"T\s*\d+|M6")
+# cutter compensation codes, G41, G42, G41.1 and G42.1
+_BAD_COMP_RE = re.compile(r"G4[12](?!\d)")
+_SPINDLE_RE = re.compile(r"\$\d+")
+
+
+def _split_comment(line):
+    # Split the line at the first ';' or '(' comment char.
+    # Returns (code, comment), comment keeps its leading char and is
+    # empty if there is no comment on the line.
+    a = line.find(';')
+    b = line.find('(')
+    if a == -1:
+        i = b
+    elif b == -1:
+        i = a
+    else:
+        i = a if a < b else b
+    return (line, '') if i == -1 else (line[:i], line[i:])
+
+
+# axis letter and value pairs for the axis sets the parsers look for.
+# Letters with no value are not matched.
+_XY_RE = re.compile(r'([XY])([\d\+\.-]+)')
+_XYIJP_RE = re.compile(r'([XYIJP])([\d\+\.-]+)')
+
+
+def _extract_axes(line, axis_re):
+    # Returns a dict of axis letter -> float value for every match of
+    # axis_re in the line.
+    return {axis: float(value) for axis, value in axis_re.findall(line)}
 
 # Enum for line type
 class Commands(Enum):
@@ -160,10 +209,117 @@ class Commands(Enum):
     REMOVE                      = auto()
 
 
+# Module level aliases of the line types used in the per line hot paths.
+# Looking an Enum member up on its class is a lot slower than reading a global.
+_CMD_PASSTHROUGH = Commands.PASSTHROUGH
+_CMD_COMMENT = Commands.COMMENT
+_CMD_OTHER = Commands.OTHER
+_CMD_XY = Commands.XY
+_CMD_REMOVE = Commands.REMOVE
+_CMD_SPINDLE_ON = Commands.SPINDLE_ON
+_CMD_SPINDLE_OFF = Commands.SPINDLE_OFF
+_CMD_TOOLCHANGE = Commands.TOOLCHANGE
+
+
+# token mapping for line commands. Each entry is
+# (token, line type, name of CodeLine parser method).
+# Order matters, the first token that prefixes the line wins.
+_TOKENS = (
+    ('G0', Commands.MOVE_LINEAR, 'parse_linear'),
+    ('G1', Commands.MOVE_LINEAR, 'parse_linear'),
+    ('G20', Commands.UNITS, 'set_inches'),
+    ('G21', Commands.UNITS, 'set_mms'),
+    ('G2', Commands.MOVE_ARC, 'parse_arc'),
+    ('G3', Commands.MOVE_ARC, 'parse_arc'),
+    #('M3$0', Commands.BEGIN_CUT),
+    #('M5$0', Commands.END_CUT),
+    #('M3$1', Commands.BEGIN_SCRIBE),
+    #('M5$1', Commands.END_SCRIBE),
+    #('M3$2', Commands.BEGIN_SPOT),
+    #('M5$2', Commands.END_SPOT),
+    #('M5$-1', Commands.END_ALL),
+    #('M190', Commands.SELECT_PROCESS, 'placeholder'),
+    #('M66P3L3', Commands.WAIT_PROCESS, 'placeholder'),
+    #('F#<_hal[plasmac.cut-feed-rate]>', Commands.FEEDRATE_MATERIAL),
+    #('M62P1', Commands.ENABLE_IGNORE_ARC_OK_SYNCH),
+    #('M64P1', Commands.ENABLE_IGNORE_ARC_OK_IMMED),
+    #('M63P1', Commands.DISABLE_IGNORE_ARC_OK_SYNCH),
+    #('M65P1', Commands.DISABLE_IGNORE_ARC_OK_IMMED),
+    #('M62P2', Commands.DISABLE_THC_SYNCH),
+    #('M64P2', Commands.DISABLE_THC_IMMED),
+    #('M63P2', Commands.ENABLE_THC_SYNCH),
+    #('M65P2', Commands.ENABLE_THC_IMMED),
+    #('M62P3', Commands.DISABLE_TORCH_SYNCH),
+    #('M64P3', Commands.DISABLE_TORCH_IMMED),
+    #('M63P3', Commands.ENABLE_TORCH_SYNCH),
+    #('M65P3', Commands.ENABLE_TORCH_IMMED),
+    #('M67E3', Commands.FEED_VEL_PERCENT_SYNCH),
+    #('M68E3', Commands.FEED_VEL_PERCENT_IMMED),
+    ('G41', Commands.CUTTER_COMP_LEFT, 'cutter_comp_error'),
+    ('G42', Commands.CUTTER_COMP_RIGHT, 'cutter_comp_error'),
+    # G41.1/G42.1 have always matched as G41/G42 above
+    #('G41.1', Commands.CUTTER_COMP_LEFT, 'cutter_comp_error'),
+    #('G42.1', Commands.CUTTER_COMP_RIGHT, 'cutter_comp_error'),
+    ('G40', Commands.CUTTER_COMP_OFF, 'placeholder'),
+    ('G64', Commands.PATH_BLENDING, 'parse_passthrough'),
+    ('M52', Commands.ADAPTIVE_FEED, 'parse_passthrough'),
+    ('M2', Commands.PROGRAM_END, 'parse_passthrough'),
+    ('M30', Commands.PROGRAM_END, 'parse_passthrough'),
+    ('M3', Commands.SPINDLE_ON, 'parse_spindle_on'),
+    ('M5', Commands.SPINDLE_OFF, 'parse_spindle_off'),
+    ('M190', Commands.MATERIAL_CHANGE, 'parse_passthrough'),
+    ('M66', Commands.DIGITAL_IN, 'parse_passthrough'),
+    ('G90', Commands.ABSOLUTE, 'parse_passthrough'),
+    ('G91', Commands.RELATIVE, 'parse_passthrough'),
+    # G91.1/G90.1 have always matched as G91/G90 above
+    #('G91.1', Commands.ARC_RELATIVE, 'parse_passthrough'),
+    #('G90.1', Commands.ARC_ABSOLUTE, 'parse_passthrough'),
+    ('F#', Commands.FEEDRATE_MATERIAL, 'parse_passthrough'),
+    ('F', Commands.FEEDRATE_LINE, 'parse_feedrate'),
+    ('#<holes>', Commands.HOLE_MODE, 'placeholder'),
+    ('#<h_diameter>', Commands.HOLE_DIAM, 'placeholder'),
+    ('#<h_velocity>', Commands.HOLE_VEL, 'placeholder'),
+    ('#<oclength>', Commands.HOLE_OVERCUT, 'placeholder'),
+    ('#<pierce-only>', Commands.PIERCE_MODE, 'placeholder'),
+    #('#<keep-z-motion>', Commands.KEEP_Z),
+    (';', Commands.COMMENT, 'parse_comment'),
+    ('(', Commands.COMMENT, 'parse_comment'),
+    ('T', Commands.TOOLCHANGE, 'parse_toolchange'),
+    #('(o=', Commands.MAGIC_MATERIAL),
+)
+
+
+def _build_token_table(tokens):
+    # Bucket the tokens by their first two chars so a line only needs to be
+    # tested against the handful of tokens that could possibly prefix it.
+    # Single char tokens are added to every bucket sharing that first char
+    # and the original token order is kept within each bucket. Tokens that
+    # can never win, because an earlier token in the bucket is a prefix of
+    # them (e.g. G41.1 after G41), are left out.
+    table = {}
+    for key in {k[:2] for k, t, h in tokens}:
+        bucket = []
+        for k, t, h in tokens:
+            if k[:2] == key or (len(k) == 1 and key[0] == k):
+                if not any(k.startswith(prev) for prev, _, _ in bucket):
+                    bucket.append((k, t, h))
+        table[key] = tuple(bucket)
+    return table
+
+
+_TOKEN_TABLE = _build_token_table(_TOKENS)
+
 
 class CodeLine:
 # Class to represent a single line of gcode
 
+    # One CodeLine is kept for every line of the file, so use slots rather
+    # than a per instance __dict__
+    __slots__ = ('_parent', 'command', 'params', 'comment', 'raw', 'errors',
+                 'type', 'is_hole', 'is_pierce', 'token',
+                 'active_g_modal_groups', 'cutchart_id', 'hole_builder',
+                 'pierce_builder', '_upper')
+
     def __init__(self, line, parent = None):
         """args:
         line:  the gcode line to be parsed
@@ -181,72 +337,25 @@ class CodeLine:
         self.token = ''
         self.active_g_modal_groups = {}
         self.cutchart_id = None
-        self.hole_builder = None
-        self.pierce_builder = None
-
-
-        # token mapping for line commands
-        tokens = {
-            'G0':(Commands.MOVE_LINEAR, self.parse_linear),
-            'G1':(Commands.MOVE_LINEAR, self.parse_linear),
-            'G20':(Commands.UNITS, self.set_inches),
-            'G21':(Commands.UNITS, self.set_mms),
-            'G2':(Commands.MOVE_ARC, self.parse_arc),
-            'G3':(Commands.MOVE_ARC, self.parse_arc),
-            #'M3$0':Commands.BEGIN_CUT,
-            #'M5$0':Commands.END_CUT,
-            #'M3$1':Commands.BEGIN_SCRIBE,
-            #'M5$1':Commands.END_SCRIBE,
-            #'M3$2':Commands.BEGIN_SPOT,
-            #'M5$2':Commands.END_SPOT,
-            #'M5$-1':Commands.END_ALL,
-            #'M190':(Commands.SELECT_PROCESS, self.placeholder),
-            #'M66P3L3':(Commands.WAIT_PROCESS, self.placeholder),
-            #'F#<_hal[plasmac.cut-feed-rate]>':Commands.FEEDRATE_MATERIAL,
-            #'M62P1':Commands.ENABLE_IGNORE_ARC_OK_SYNCH,
-            #'M64P1':Commands.ENABLE_IGNORE_ARC_OK_IMMED,
-            #'M63P1':Commands.DISABLE_IGNORE_ARC_OK_SYNCH,
-            #'M65P1':Commands.DISABLE_IGNORE_ARC_OK_IMMED,
-            #'M62P2':Commands.DISABLE_THC_SYNCH,
-            #'M64P2':Commands.DISABLE_THC_IMMED,
-            #'M63P2':Commands.ENABLE_THC_SYNCH,
-            #'M65P2':Commands.ENABLE_THC_IMMED,
-            #'M62P3':Commands.DISABLE_TORCH_SYNCH,
-            #'M64P3':Commands.DISABLE_TORCH_IMMED,
-            #'M63P3':Commands.ENABLE_TORCH_SYNCH,
-            #'M65P3':Commands.ENABLE_TORCH_IMMED,
-            #'M67E3':Commands.FEED_VEL_PERCENT_SYNCH,
-            #'M68E3':Commands.FEED_VEL_PERCENT_IMMED,
-            'G41':(Commands.CUTTER_COMP_LEFT, self.cutter_comp_error),
-            'G42':(Commands.CUTTER_COMP_RIGHT, self.cutter_comp_error),
-            'G41.1':(Commands.CUTTER_COMP_LEFT, self.cutter_comp_error),
-            'G42.1':(Commands.CUTTER_COMP_RIGHT, self.cutter_comp_error),
-            'G40':(Commands.CUTTER_COMP_OFF, self.placeholder),
-            'G64':(Commands.PATH_BLENDING, self.parse_passthrough),
-            'M52':(Commands.ADAPTIVE_FEED, self.parse_passthrough),
-            'M2':(Commands.PROGRAM_END, self.parse_passthrough),
-            'M30':(Commands.PROGRAM_END, self.parse_passthrough),
-            'M3':(Commands.SPINDLE_ON, self.parse_spindle_on),
-            'M5':(Commands.SPINDLE_OFF, self.parse_spindle_off),
-            'M190':(Commands.MATERIAL_CHANGE, self.parse_passthrough),
-            'M66':(Commands.DIGITAL_IN, self.parse_passthrough),
-            'G90':(Commands.ABSOLUTE, self.parse_passthrough),
-            'G91':(Commands.RELATIVE, self.parse_passthrough),
-            'G91.1':(Commands.ARC_RELATIVE, self.parse_passthrough),
-            'G90.1':(Commands.ARC_ABSOLUTE, self.parse_passthrough),
-            'F#':(Commands.FEEDRATE_MATERIAL, self.parse_passthrough),
-            'F':(Commands.FEEDRATE_LINE, self.parse_feedrate),
-            '#<holes>':(Commands.HOLE_MODE, self.placeholder),
-            '#<h_diameter>':(Commands.HOLE_DIAM, self.placeholder),
-            '#<h_velocity>':(Commands.HOLE_VEL, self.placeholder),
-            '#<oclength>':(Commands.HOLE_OVERCUT, self.placeholder),
-            '#<pierce-only>':(Commands.PIERCE_MODE, self.placeholder),
-            #'#<keep-z-motion>':Commands.KEEP_Z,
-            ';':(Commands.COMMENT, self.parse_comment),
-            '(':(Commands.COMMENT, self.parse_comment),
-            'T':(Commands.TOOLCHANGE, self.parse_toolchange)
-            #'(o=':Commands.MAGIC_MATERIAL
-            }
+        # upper case copy of the line shared by the parse methods. It is
+        # released once the line has been parsed.
+        self._upper = line.upper()
+        line_upper = self._upper.strip()
+
+        # Lines without any G, M or T letters can not hold a code, so the
+        # common bare XY moves and comments can skip the scans below.
+        first = self._upper[:1]
+        if first in ('X', 'Y', ';', '(') and 'G' not in line_upper and \
+                'M' not in line_upper and 'T' not in line_upper:
+            if first == 'X' or first == 'Y':
+                self.type = _CMD_XY
+                self.params = _extract_axes(line_upper, _XY_RE)
+            else:
+                self.type = _CMD_COMMENT
+                self.token = first
+                self.parse_comment()
+            del self._upper
+            return
 
         # a line could have multiple Gcodes on it. This is typical of the
         # preamble set by many CAM packages.  The processor should not need
@@ -255,70 +364,60 @@ class CodeLine:
         # [1] Recognise it is there
         # [2] Scan for any illegal codes, set any error codes if needed
         # [3] Mark line for pass through
-        multi_codes = re.findall(r"G\d+|T\s*\d+|M\d+", line.upper().strip())
+        multi_codes = _MULTI_CODES_RE.findall(line_upper)
         if len(multi_codes) > 1:
             LOG.debug('Codeline: Multi codes on line detected')
             # we have multiple codes on the line
-            self.type = Commands.PASSTHROUGH
+            self.type = _CMD_PASSTHROUGH
             # scan for possible 'bad' codes
+            if _BAD_COMP_RE.search(line_upper) is not None:
+                # we have an error state
+                self.cutter_comp_error()
             for code in multi_codes:
-                if code in ('G41','G42','G41.1','G42.1'):
-                    # we have an error state
-                    self.cutter_comp_error()
-                # look for G90
-                if code == 'G90':
-                    self._parent.set_active_g_modal('G90')
-                # look for G90
-                if code == 'G91':
-                    self._parent.set_active_g_modal('G91')
+                # look for G90 or G91
+                if code == 'G90' or code == 'G91':
+                    self._parent.set_active_g_modal(code)
             # look for Tx M6 combo
-            f = re.findall("T\s*\d+|M6", line.upper().strip())
+            f = _TOOL_M6_RE.findall(line_upper)
             if len(f) == 2:
                 # we have a tool change combo. Assume in form Tx M6
                 self.parse_toolchange(combo=True)
         else:
             # not a multi code on single line situation so process line
             # to set line type
-            LOG.debug('Codeline: Non-Multi code: Scan tokens on line.')
-            for k in tokens:
-                # do regex searches to find exact matches of the token patterns
-                pattern = r"^"+k + r"{1}"
-                if k == '(':
-                    # deal with escaping the '(' which is special char in regex
-                    pattern = r"^\({1}"
-                r = re.search(pattern, line.upper())
-                if r != None:
-                    # since r is NOT None we must have found something
-                    self.type = tokens[k][0]
+            line_upper = self._upper
+            # nothing of interest just mark the line for pass through processing
+            self.type = _CMD_PASSTHROUGH
+            # only the tokens sharing the leading chars of the line can match
+            candidates = _TOKEN_TABLE.get(line_upper[:2]) or _TOKEN_TABLE.get(line_upper[:1], ())
+            for k, cmd_type, handler in candidates:
+                if line_upper.startswith(k):
+                    # we found an exact match of the token
+                    self.type = cmd_type
                     self.token = k
                     # call the parser method bound to this key
-                    tokens[k][1]()
+                    getattr(self, handler)()
                     # check for an inline comment if the entire line is not a comment
-                    if self.type is not Commands.COMMENT:
+                    if self.type is not _CMD_COMMENT:
                         self.parse_inline_comment()
                     # break out of the loop, we found a match
                     break
-                else:
-                    # nothing of interest just mark the line for pass through processing
-                    self.type = Commands.PASSTHROUGH
-            if self.type is Commands.PASSTHROUGH:
-                LOG.debug('Codeline: Command type = PASSTHROUGH: Do further checks, e.g. XY line/')
+            if self.type is _CMD_PASSTHROUGH:
                 # If the result was seen as 'OTHER' do some further checks
                 # As soon as we shift off being type OTHER, exit the method
                 # 1. is it an XY line
                 self.parse_XY_line()
                 #if self.type is not Commands.OTHER: return
+        del self._upper
 
 
     def strip_inline_comment(self, line):
-        s = re.split(";|\(", line, 1)
-        try:
-            return s[0].strip()
-        except:
-            return line
+        return _split_comment(line)[0].strip()
 
     def save_g_modal_group(self, grp):
-        self.active_g_modal_groups = grp.copy()
+        # grp is a snapshot shared by all the lines parsed while the modal
+        # state is unchanged, so it must not be modified
+        self.active_g_modal_groups = grp
 
 
     def parse_comment(self):
@@ -328,18 +427,9 @@ class CodeLine:
 
 
     def parse_inline_comment(self):
-        # look for possible inline comment
-        s = re.split(";|\(",self.raw[1:],1)
-        robj = re.search(";|\(",self.raw[1:])
-        if robj != None:
-            # found an inline comment. get the char token for the comment
-            i = robj.start() + 1
-            found_c = self.raw[i]
-            self.comment = found_c + s[1]
-        else:
-            # no comment found to empty the char token var
-            found_c = ''
-            self.comment = ''
+        # look for possible inline comment. If none is found the
+        # comment is left empty
+        self.comment = _split_comment(self.raw[1:])[1]
 
 
     def parse_other(self):
@@ -347,54 +437,40 @@ class CodeLine:
         pass
 
     def parse_passthrough(self):
-        self.type = Commands.PASSTHROUGH
+        self.type = _CMD_PASSTHROUGH
 
     def parse_remove(self):
-        self.type = Commands.REMOVE
+        self.type = _CMD_REMOVE
 
     def parse_linear(self):
         # linear motion means either G0 or G1. So looking for X/Y on this line
         self.command = ('G',int(self.token[1:]))
         # split the raw line at the token and then look for X/Y existence
-        line = self.raw.upper().split(self.token,1)[1].strip()
-        tokens = re.finditer(r"X[\d\+\.-]*|Y[\d\+\.-]*", line)
-        for token in tokens:
-            params = re.findall(r"X|Y|[\d\+\.-]+", token.group())
-            # this is now a list which can be added to the params dictionary
-            if len(params) == 2:
-                self.params[params[0]] = float(params[1])
+        line = self._upper.split(self.token,1)[1].strip()
+        self.params = _extract_axes(line, _XY_RE)
 
 
     def parse_XY_line(self):
-        line = self.raw.upper().strip()
-        tokens = re.finditer(r"X[\d\+\.-]*|Y[\d\+\.-]*", line)
-        for token in tokens:
-            params = re.findall(r"X|Y|[\d\+\.-]+", token.group())
-            # this is now a list which can be added to the params dictionary
-            if len(params) == 2:
-                self.params[params[0]] = float(params[1])
-            # if we are in the loop then we found X/Y instances so mark the line type
-            self.type = Commands.XY
+        line = self._upper.strip()
+        self.params = _extract_axes(line, _XY_RE)
+        if 'X' in line or 'Y' in line:
+            # we found X/Y instances so mark the line type
+            self.type = _CMD_XY
 
 
     def parse_arc(self):
         # arc motion means either G2 or G3. So looking for X/Y/I/J/P on this line
         self.command = ('G',int(self.token[1:]))
         # split the raw line at the token and then look for X/Y/I/J/P existence
-        line = self.strip_inline_comment(self.raw).upper().split(self.token,1)[1].strip()
-        tokens = re.finditer(r"X[\d\+\.-]*|Y[\d\+\.-]*|I[\d\+\.-]*|J[\d\+\.-]*|P[\d\+\.-]*", line)
-        for token in tokens:
-            params = re.findall(r"X|Y|I|J|P|[\d\+\.-]+", token.group())
-            # this is now a list which can be added to the params dictionary
-            if len(params) == 2:
-                self.params[params[0]] = float(params[1])
+        line = self.strip_inline_comment(self._upper).split(self.token,1)[1].strip()
+        self.params = _extract_axes(line, _XYIJP_RE)
 
     def parse_spindle_on(self):
-        self.type = Commands.SPINDLE_ON
+        self.type = _CMD_SPINDLE_ON
         self.command = ('M', int(self.token[1:]))
         # split the raw line at the token
-        line = self.strip_inline_comment(self.raw).upper().split(self.token,1)[1].strip()
-        params = re.findall('\$\d+', line)
+        line = self.strip_inline_comment(self._upper).split(self.token,1)[1].strip()
+        params = _SPINDLE_RE.findall(line)
         if len(params) == 1:
             self.params['$'] = int(params[0][1:])
         elif len(params) == 0:
@@ -402,11 +478,11 @@ class CodeLine:
             self.params['$'] = int(0)
     
     def parse_spindle_off(self):
-        self.type = Commands.SPINDLE_OFF
+        self.type = _CMD_SPINDLE_OFF
         self.command = ('M', int(self.token[1:]))
         # split the raw line at the token
-        line = self.strip_inline_comment(self.raw).upper().split(self.token,1)[1].strip()
-        params = re.findall('\$\d+', line)
+        line = self.strip_inline_comment(self._upper).split(self.token,1)[1].strip()
+        params = _SPINDLE_RE.findall(line)
         if len(params) == 1:
             self.params['$'] = int(params[0][1:])
         elif len(params) == 0:
@@ -420,18 +496,18 @@ class CodeLine:
         # the CustChart table. This will need to be supported by the
         # CAM having a loading of tools where the tool #  is the ID from this table
         # Param: combo - if True then line has both Tx and M6
-        line = self.strip_inline_comment(self.raw)
         if combo:
-            f = re.findall(r"T\s*\d+|M6", line.upper().strip())
+            f = _TOOL_M6_RE.findall(self.strip_inline_comment(self._upper))
             # assume is in format Tx M6
-            tool = int(re.split('T', f[0], 1)[1])
-            self.type = Commands.PASSTHROUGH
+            tool = int(f[0].split('T', 1)[1])
+            self.type = _CMD_PASSTHROUGH
         else:
-            tool = int(re.split('T', line, 1)[1])
+            line = self.strip_inline_comment(self.raw)
+            tool = int(line.split('T', 1)[1])
             self.command = ('T',tool)
-            self.type = Commands.TOOLCHANGE
+            self.type = _CMD_TOOLCHANGE
         # test if this process ID is known about
-        cut_process = PLASMADB.cut_by_id(tool)
+        cut_process = _cached_cut_by_id(tool)
         if len(cut_process) == 0:
             # rewrite the raw line as an error comment
             self.raw = f"; ERROR: Invalid Cutchart ID in Tx. Check CAM Tools: {self.raw}"
@@ -449,7 +525,7 @@ class CodeLine:
     def parse_feedrate(self):
         # assumption is that the feed is on its own line
         line = self.strip_inline_comment(self.raw)
-        feed = float(re.split('F', line, 1)[1])
+        feed = float(line.split('F', 1)[1])
         if self._parent.active_feedrate is not None:
             feed = self._parent.active_feedrate
         self.command = ('F', feed)
@@ -473,16 +549,50 @@ class CodeLine:
                                     Ensure all compensation is baked into the tool path."
         print(f'ERROR:CUTTER_COMP:INVALID GCODE FOUND',file=sys.stderr)
         sys.stderr.flush()
-        self.type = Commands.REMOVE
+        self.type = _CMD_REMOVE
 
     def get_active_feedrate(self):
         return self._parent.active_feedrate
 
+    def get_cached_percents(self):
+        return self._parent.get_cached_percents()
+
     def placeholder(self):
         LOG.debug(f'Type PLACEHOLDER -- {self.token} -- found - this code is not handled or considered')
         pass
 
 
+# gcode element line formats for the configured precision
+if PRECISION == 4:
+    _FMT_XY = '%s x%.4f y%.4f'
+    _FMT_XY_IJ = '%s x%.4f y%.4f i%.4f j%.4f'
+else:
+    _FMT_XY = '%s x%.6f y%.6f'
+    _FMT_XY_IJ = '%s x%.6f y%.6f i%.6f j%.6f'
+
+_PI = math.pi
+
+# unit circle end points for a hole cut as four ccw quarter arcs,
+# starting from 12 O'clock
+_UNIT_ARC_QUAD = ((-1.0, 0.0), (0.0, -1.0), (1.0, 0.0), (0.0, 1.0))
+
+
+def _sector_end_points(cx, cy, r, split_angles):
+    # Returns the (x, y) end point on the hole circle for each of the
+    # split angles. Angles are in radians measured from 12 O'clock.
+    full_circle = _PI * 2  # 360 degrees. We need to use this for a segment moving to 12 O'clock
+    degs90 = _PI / 2
+    points = []
+    for sang in split_angles:
+        if sang == full_circle or sang == 0:
+            #reset coordinates to 0,0 if angle = 360 degrees. We want the next segments to refer to 0 degrees
+            points.append((cx, cy + r))
+        else:
+            ang = sang + degs90
+            points.append((cx + r * math.cos(ang), cy + r * math.sin(ang)))
+    return points
+
+
 class HoleBuilder:
     def __init__(self):
         torch_on = False
@@ -490,120 +600,61 @@ class HoleBuilder:
 
     def degrees(self, rad):
         #convert radians to degrees to help decipher the angles
-        return(rad *(180/math.pi))
+        return math.degrees(rad)
 
-    def line_length(self, x1, y1, x2, y2):
-        a = (x2 - x1)**2
-        b = (y2 - y1)**2
-        s = a + b
-        rtn = math.sqrt(s)
-        return rtn
+    @staticmethod
+    def line_length(x1, y1, x2, y2):
+        return math.hypot(x2 - x1, y2 - y1)
 
     def create_ccw_arc_gcode(self, x, y, rx, ry):
-        return {
-            "code": "G3",
-            "x": x,
-            "y": y,
-            "i": rx,
-            "j": ry
-        }
+        return _FMT_XY_IJ % ("G3", x, y, rx, ry)
 
     def create_cw_arc_gcode(self, x, y, rx, ry):
-        return {
-            "code": "G2",
-            "x": x,
-            "y": y,
-            "i": rx,
-            "j": ry
-        }
+        return _FMT_XY_IJ % ("G2", x, y, rx, ry)
 
     def create_line_gcode(self, x, y, rapid):
-        return {
-            "code": "G0" if rapid else "G1",
-            "x": x,
-            "y": y
-        }
+        return _FMT_XY % ("G0" if rapid else "G1", x, y)
 
     def create_cut_on_off_gcode(self, cut_on, spindle=0):
         self.torch_on = cut_on
-        return {
-            "code": f"M3 ${spindle}" if cut_on else "M5 $-1"
-        }
+        return f"M3 ${spindle}" if cut_on else "M5 $-1"
 
     def create_kerf_off_gcode(self):
-        return {
-            "code": "G40"
-        }
+        return "G40"
 
     def create_comment(self, txt):
-        return {
-            "code": f"({txt})"
-        }
+        return f"({txt})"
         
     def create_debug_comment(self, txt):
-        return {
-            "code": f"{txt}" if DEBUG_COMMENTS else None
-        }
+        return f"{txt}" if DEBUG_COMMENTS else None
 
     def create_dwell(self, t):
         # add a G4 Pn dwell between segments
-        return {
-             "code": f"G4 P{t}"
-        }
+        return f"G4 P{t}"
         
     def create_feed(self, r):
-        return {
-            "code": f"F{r}"
-        }
+        return f"F{r}"
     
     def create_absolute_arc(self):
-        return {
-            "code": "G90.1"
-        }
+        return "G90.1"
 
     def create_relative_arc(self):
-        return {
-            "code": "G91.1"
-        }
+        return "G91.1"
 
     def create_thc_off_synch(self):
-        return {
-            "code": "M62 P2"
-        }
+        return "M62 P2"
 
     def create_thc_on_synch(self):
-        return {
-            "code": "M63 P2"
-        }
+        return "M63 P2"
         
     def create_relative(self):
-        return {
-            "code": "G91"
-        }
+        return "G91"
     
     def create_absolute(self):
-        return {
-            "code": "G90"
-        }
-
-    def element_to_gcode_line(self, e):
-        if PRECISION == 4:
-            xy = '{} x{:.4f} y{:.4f}'
-            ij = ' i{:.4f} j{:.4f}'
-        else:
-            xy = '{} x{:.6f} y{:.6f}'
-            ij = ' i{:.6f} j{:.6f}'
-        
-        if 'i' in e:
-            line = (xy + ij).format(e['code'], e['x'], e['y'], e['i'], e['j'])
-        elif 'x' in e:
-            line = xy.format(e['code'], e['x'], e['y'])
-        else:
-            line = e['code']
-        return line
+        return "G90"
 
     def plasma_mark(self, line, x, y, delay):
-        self.elements=[]
+        self.elements.clear()
         feed_rate = line.get_active_feedrate()
         self.elements.append(self.create_comment('---- Marking/Spotting Start ----'))
         #self.elements.append(self.create_feed(feed_rate))
@@ -630,10 +681,11 @@ class HoleBuilder:
         # often code is already compensated. We need to be able to tell the script if it is
         #changed the radius parameter to be ad diameter which is more in keeping with the hole data methodology
         feed_rate = line.get_active_feedrate()
-        arc1_feed = feed_rate * hal.get_value('qtpyvcp.plasma-arc1-percent.out')/100
-        arc2_feed = feed_rate * hal.get_value('qtpyvcp.plasma-arc2-percent.out')/100
-        arc3_feed = feed_rate * hal.get_value('qtpyvcp.plasma-arc3-percent.out')/100
-        leadin_feed = feed_rate * hal.get_value('qtpyvcp.plasma-leadin-percent.out')/100
+        percents = line.get_cached_percents()
+        arc1_feed = feed_rate * percents['arc1']/100
+        arc2_feed = feed_rate * percents['arc2']/100
+        arc3_feed = feed_rate * percents['arc3']/100
+        leadin_feed = feed_rate * percents['leadin']/100
 
         # is G40 oavtive or not
         if line.active_g_modal_groups[7] == 'G40':
@@ -646,31 +698,16 @@ class HoleBuilder:
         # kerf larger than hole -> hole disappears
         # Mark that hole has been ignored with a comment.
         if kc > r:
-            self.elements = []
+            self.elements.clear()
             self.elements.append(self.create_comment('1/2 Kerf > Hole Radius.  Smart Hole processing skipped.'))
             return
 
         # convert split distances to angles (in radians)
-        split_angles = []
-        full_circle = math.pi * 2  # 360 degrees. We need to use this for a segment moving to 12 O'clock
-        degs90 = math.pi / 2
-        crossed_origin = False
-        for spt in splits:
-            # using the relationship of arc_length/circumfrance = angle/360 if you work the algebra you find:
-            # angle = arc_length/radius (in radians)
-            tmp_ang = float(spt) / float(r)     # need to typecast to prevent Python from truncating to whole values, maybe should be double?
-            this_ang = tmp_ang    # Accoding to Juha, all angles are from 0 degrees, -ve angles to the right, +ve angles to the left
-            # this_ang = full_circle + tmp_ang    # Accoding to Juha, all angles are from 0 degrees, -ve angles to the right, +ve angles to the left
-            # if (this_ang > full_circle) and (crossed_origin == False):
-            #     # Has this split got to the 0deg/360 deg  origin?
-            #     # when we cross the origin, add a 360 degree keep it in the correct order
-            #     split_angles.append(full_circle)
-            #     this_ang = tmp_ang
-            #     crossed_origin = True
-            split_angles.append(this_ang)
-        #Sorting is not helpful with splits becasue the smaller values come befor ethe first segment.
-        #We need to keep ssegments in order
-        #sort angles, smallest first
+        # using the relationship of arc_length/circumfrance = angle/360 if you work the algebra you find:
+        # angle = arc_length/radius (in radians)
+        # Accoding to Juha, all angles are from 0 degrees, -ve angles to the right, +ve angles to the left
+        # Segments are kept in the given order, they are not sorted.
+        split_angles = [float(spt) / r for spt in splits] if splits else []
 
         # compensate hole radius and leadin radius if not already compensated code
         # Testing for g40 active.  HOWEVER using a G41/42 code causes so many lost plasmac featrues
@@ -683,7 +720,7 @@ class HoleBuilder:
         arc_y0 = y + r
 
         # make sure gcode elements list is empty
-        self.elements = []
+        self.elements.clear()
 
         if line.active_g_modal_groups[4] == 'G91.1':
             self.elements.append(self.create_absolute_arc())
@@ -795,16 +832,11 @@ class HoleBuilder:
         cx = x
         cy =  y
 
-        if len(split_angles) > 0:
+        if split_angles:
             sector_num = 0
-            for sang in split_angles:
+            end_points = _sector_end_points(cx, cy, r, split_angles)
+            for sang, (end_x, end_y) in zip(split_angles, end_points):
                 end_angle = sang
-                end_x = ( cx + r * math.cos(end_angle + degs90))
-                end_y = ( cy + r * math.sin(end_angle + degs90))
-                if sang == full_circle or sang == 0:
-                    #reset coordinates to 0,0 if angle = 360 degrees. We want the next segments to refer to 0 degrees
-                    end_x = x
-                    end_y = y + r
                 # if sang < split_angles[0] and sang > 0.00:
                 #     #conditional to coordinate positive angles
                 #     end_x = (cx - r * math.cos(end_angle + degs90))
@@ -829,10 +861,8 @@ class HoleBuilder:
                 sector_num += 1
         else:
             # create hole as four arcs. no overburn or anything special.
-            self.elements.append(self.create_ccw_arc_gcode(x-r, y, x, y))
-            self.elements.append(self.create_ccw_arc_gcode(x, y-r, x, y))
-            self.elements.append(self.create_ccw_arc_gcode(x+r, y, x, y))
-            self.elements.append(self.create_ccw_arc_gcode(x, y+r, x, y))
+            for dx, dy in _UNIT_ARC_QUAD:
+                self.elements.append(self.create_ccw_arc_gcode(x + dx * r, y + dy * r, x, y))
 
         # TORCH OFF
         if self.torch_on:
@@ -844,56 +874,55 @@ class HoleBuilder:
         if line.active_g_modal_groups[4] == 'G91.1':
             self.elements.append(self.create_relative_arc())
 
-    def generate_hole_gcode(self):
-        for e in self.elements:
-            if e['code'] is not None:
-                print(self.element_to_gcode_line(e), file=sys.stdout)
-                sys.stdout.flush()
+    def generate_hole_gcode(self, out_lines):
+        # add the gcode lines for the hole to the out_lines list.
+        # Elements are already rendered, None marks a skipped debug comment
+        out_lines.extend(e for e in self.elements if e is not None)
 
 
 class PierceBuilder:
-    def generate_pierce_gcode(self, line):
-        print('M3 $0', file=sys.stdout)
+    def generate_pierce_gcode(self, line, out_lines):
+        # add the gcode lines for the pierce to the out_lines list
+        out_lines.append('M3 $0')
         if line.active_g_modal_groups[3] == 'G90':
             # shift from absolute to relative
-            print('G91', file=sys.stdout)
+            out_lines.append('G91')
         # small wiggle
-        print('G1 X0.0001', file=sys.stdout)
+        out_lines.append('G1 X0.0001')
         if line.active_g_modal_groups[3] == 'G90':
             # shift back to absolute
-            print('G90', file=sys.stdout)
-        print('M5 $0', file=sys.stdout)
-        sys.stdout.flush()
+            out_lines.append('G90')
+        out_lines.append('M5 $0')
 
 
 class HiDefHole:
     def __init__(self, data_list):
-        self.hole_list = []
-        for d in data_list:
-            self.hole_list.append({'hole': d.hole_size, \
-                                   'leadinradius': d.leadin_radius, \
-                                   'kerf': d.kerf, \
-                                   'cutheight': d.cut_height, \
-                                   'speed1': d.speed1, \
-                                   'speed2': d.speed2, \
-                                   'speed2dist': d.speed2_distance, \
-                                   'offdistance': d.plasma_off_distance, \
-                                   'overcut': d.over_cut, \
-                                   'amps': d.amps
-                                   })
-        for i in range(len(self.hole_list)):
-            # calculate the scale factors to use.
-            # Factors are scaled over the diameter range of the hole
-            if i > 0:
-                delta = self.hole_list[i]['hole'] - self.hole_list[i-1]['hole']
-                self.hole_list[i]['scale_leadinradius'] = self.hole_list[i]['leadinradius']/delta
-                self.hole_list[i]['scale_kerf'] = self.hole_list[i]['kerf']/delta
-                self.hole_list[i]['scale_cutheight'] = self.hole_list[i]['cutheight']/delta
-                self.hole_list[i]['scale_speed1'] = self.hole_list[i]['speed1']/delta
-                self.hole_list[i]['scale_speed2'] = self.hole_list[i]['speed2']/delta
-                self.hole_list[i]['scale_speed2dist'] = self.hole_list[i]['speed2dist']/delta
-                self.hole_list[i]['scale_offdistance'] = self.hole_list[i]['offdistance']/delta
-                self.hole_list[i]['scale_overcut'] = self.hole_list[i]['overcut']/delta
+        # hole data comes ordered by hole_size. Keep the hole sizes and the
+        # scale factors for each attribute as parallel lists so the hole
+        # range can be found with a binary search.
+        self.holes = [d.hole_size for d in data_list]
+        columns = {'leadinradius': [d.leadin_radius for d in data_list],
+                   'kerf': [d.kerf for d in data_list],
+                   'cutheight': [d.cut_height for d in data_list],
+                   'speed1': [d.speed1 for d in data_list],
+                   'speed2': [d.speed2 for d in data_list],
+                   'speed2dist': [d.speed2_distance for d in data_list],
+                   'offdistance': [d.plasma_off_distance for d in data_list],
+                   'overcut': [d.over_cut for d in data_list]}
+        # calculate the scale factors to use.
+        # Factors are scaled over the diameter range of the hole
+        deltas = [self.holes[i] - self.holes[i-1] for i in range(1, len(self.holes))]
+        self.scales = {}
+        for attribute, values in columns.items():
+            self.scales[attribute] = [None] + [v / delta for v, delta in zip(values[1:], deltas)]
+
+    def hole_index(self, holesize):
+        # index of the first hole size range that holesize falls in,
+        # or None if it is outside all of them
+        i = bisect_left(self.holes, holesize, 1)
+        if i >= len(self.holes) or self.holes[i-1] > holesize:
+            return None
+        return i
 
     def get_attribute(self, attribute, holesize):
         """
@@ -907,12 +936,22 @@ class HiDefHole:
             offdistance
             overcut
         """
-        for i in range(1, len(self.hole_list)):
-            if self.hole_list[i-1]['hole'] <= holesize and holesize <= self.hole_list[i]['hole']:
-                lr = holesize * self.hole_list[i][f'scale_{attribute}']
-                return lr
-        return None
+        i = self.hole_index(holesize)
+        if i is None:
+            return None
+        return holesize * self.scales[attribute][i]
 
+    def get_all(self, holesize):
+        """
+        Returns all the attributes for holesize in the order:
+            leadinradius, kerf, cutheight, speed1, speed2,
+            speed2dist, offdistance, overcut
+        or None if holesize is outside the hole data.
+        """
+        i = self.hole_index(holesize)
+        if i is None:
+            return None
+        return tuple(holesize * scale[i] for scale in self.scales.values())
 
     def leadin_radius(self, holesize):
         return self.get_attribute('leadinradius', holesize)
@@ -943,11 +982,15 @@ class PreProcessor:
     def __init__(self, inCode):
         self._new_gcode = []
         self._parsed = []
+        self._g3_lines = []
+        self._m3_lines = []
+        self._m5_lines = []
         self._line = ''
         self._line_num = 0
         self._line_type = 0
         self._orig_gcode = None
         self.active_g_modal_grps = {}
+        self._g_modal_snapshot = None
         self.active_m_modal_grps = {}
         self.active_cutchart = None
         self.active_feedrate = None
@@ -955,21 +998,48 @@ class PreProcessor:
         self.active_machineid = None
         self.active_thicknessid = None
         self.active_materialid = None
+        self._cached_percents = None
+        self._hal = None
         
 
-        openfile= open(inCode, 'r')
-        self._orig_gcode = openfile.readlines()
-        openfile.close()
+        with open(inCode, 'r', buffering=1 << 20) as openfile:
+            # split on newlines only. splitlines() would also break lines
+            # at form feeds and other unicode line boundaries
+            self._orig_gcode = openfile.read().split('\n')
+        # a trailing newline leaves an empty last entry that readlines()
+        # would not have produced
+        if self._orig_gcode[-1] == '':
+            self._orig_gcode.pop()
 
     def set_active_g_modal(self, gcode):
         # get the modal grp for the code and set things
         # if a code is not found then nothing will be set
         for g_modal_grp in G_MODAL_GROUPS:
             if gcode in G_MODAL_GROUPS[g_modal_grp]:
-                self.active_g_modal_grps[g_modal_grp] = gcode
+                if self.active_g_modal_grps.get(g_modal_grp) != gcode:
+                    self.active_g_modal_grps[g_modal_grp] = gcode
+                    # lines parsed from here on need a new snapshot
+                    self._g_modal_snapshot = None
                 break
 
 
+    def refresh_cached_percents(self):
+        # cache the smart hole feed percentages from HAL. These are UI
+        # settings that do not change while a file is processed, so they
+        # are read once when the first smart hole is built
+        self._cached_percents = {
+            'arc1': hal.get_value('qtpyvcp.plasma-arc1-percent.out'),
+            'arc2': hal.get_value('qtpyvcp.plasma-arc2-percent.out'),
+            'arc3': hal.get_value('qtpyvcp.plasma-arc3-percent.out'),
+            'leadin': hal.get_value('qtpyvcp.plasma-leadin-percent.out')}
+
+
+    def get_cached_percents(self):
+        if self._cached_percents is None:
+            self.refresh_cached_percents()
+        return self._cached_percents
+
+
     def active_motion_code(self):
         try:
             return self.active_g_modal_grps[1]
@@ -977,247 +1047,202 @@ class PreProcessor:
             return None
 
 
-    def flag_holes(self):
-        # connect to HAL and collect the data we need to determine what holes
-        # should be processes and what are too large
-        thickness_ratio = hal.get_value('qtpyvcp.plasma-hole-thickness-ratio.out')
-        max_hole_size = hal.get_value('qtpyvcp.plasma-max-hole-size.out')
-        
-        arc1_feed_percent = hal.get_value('qtpyvcp.plasma-arc1-percent.out')/100
-        
-        arc2_distance = hal.get_value('qtpyvcp.plasma-arc2-distance.out')
-        arc2_feed_percent = hal.get_value('qtpyvcp.plasma-arc2-percent.out')/100
-        
-        arc3_distance = hal.get_value('qtpyvcp.plasma-arc3-distance.out')
-        arc3_feed_percent = hal.get_value('qtpyvcp.plasma-arc3-percent.out')/100
-        
-        leadin_feed_percent = hal.get_value('qtpyvcp.plasma-leadin-percent.out')/100
-        leadin_radius = hal.get_value('qtpyvcp.plasma-leadin-radius.out')
-        
-        kerf_width = hal.get_value('qtpyvcp.param-kirfwidth.out')
+    def _mark_m3_m5_removal(self, i):
+        # mark the lines from the M3 before the hole at i through to the M5
+        # after it as Commands.REMOVE, along with any G0 moves leading
+        # up to the M3
+        parsed = self._parsed
+        k = bisect_left(self._m3_lines, i) - 1
+        m3 = self._m3_lines[k] if k >= 0 else -1
+        # every line between the M3 and the hole is removed. Lines before
+        # the first motion code have no grp 1 and stop the scan, so only
+        # skip straight to the M3 when the lines after it all have one.
+        found_m3 = False
+        if 1 in parsed[m3+1].active_g_modal_groups:
+            for prev in parsed[m3+1:i]:
+                prev.type = _CMD_REMOVE
+            start = m3
+        else:
+            start = i-1
+        for j in range(start, -1, -1):
+            prev = parsed[j]
+            # mark for removal any lines until find the M3
+            if prev.command == ('M', 3):
+                found_m3 = True
+                prev.type = _CMD_REMOVE
+            if not found_m3:
+                prev.type = _CMD_REMOVE
+            mg1 = prev.active_g_modal_groups.get(1)
+            if mg1 is None:
+                # no motion mode set yet so no longer in a g0 mode
+                break
+            if mg1 != 'G0' and found_m3:
+                break
+            elif mg1 == 'G0':
+                prev.type = _CMD_REMOVE
+        # mark all lines for removal up to and including the next M5
+        k = bisect_right(self._m5_lines, i)
+        end = self._m5_lines[k]+1 if k < len(self._m5_lines) else len(parsed)
+        for next in parsed[i+1:end]:
+            next.type = _CMD_REMOVE
 
-        torch_off_distance_before_zero = hal.get_value('qtpyvcp.plasma-torch-off-distance.out')
-        
-        small_hole_size = 0
+
+    def _load_hal_params(self):
+        # connect to HAL and collect the data we need to determine what holes
+        # should be processes and what are too large. These do not change
+        # while a file is processed so are only read the once.
         small_hole_detect = hal.get_value('qtpyvcp.plasma-small-hole-detect.checked')
-        if small_hole_detect:
-            small_hole_size = hal.get_value('qtpyvcp.plasma-small-hole-threshold.out')
-            
-        marking_voltage = hal.get_value('qtpyvcp.spot-threshold.out')
-        marking_delay = hal.get_value('qtpyvcp.spot-delay.out')
-        
-        
-        # old school loop so we can easily peek forward or back of the current
-        # record being processed.
-        i = 0
-        while i < len(self._parsed):
-            line = self._parsed[i]
-            if len(line.command) == 2:
-                if line.command[0] == 'G' and line.command[1] == 3:
-                    # this could be a hole, test for it.
-                    # NB: Only circles that are defined as cww are deemed to be
-                    # a hole.  cw (G2) cuts are deemed as an outer edge not inner.
-                                        
-                    #[1] find the last X and Y position while grp 1 was either G0 or G1
-                    j = i-1
-                    for j in range(j, -1, -1):
-                        prev = self._parsed[j]
-                        # is there an X or Y in the line
-                        if 'X' in prev.params.keys() and prev.active_g_modal_groups[1] in ('G0','G1','G2','G3'):
-                            lastx = prev.params['X']
-                            break
-                    j = i-1
-                    for j in range(j, -1, -1):
-                        prev = self._parsed[j]
-                        # is there an X or Y in the line
-                        if 'Y' in prev.params.keys() and prev.active_g_modal_groups[1] in ('G0','G1','G2','G3'):
-                            lasty = prev.params['Y']
-                            break
-                    endx = line.params['X'] if 'X' in line.params.keys() else lastx
-                    endy = line.params['Y'] if 'Y' in line.params.keys() else lasty
-                    if endx == lastx and endy == lasty:
-                        line.is_hole = True
+        self._hal = SimpleNamespace(
+            thickness_ratio=hal.get_value('qtpyvcp.plasma-hole-thickness-ratio.out'),
+            max_hole_size=hal.get_value('qtpyvcp.plasma-max-hole-size.out'),
+            arc2_distance=hal.get_value('qtpyvcp.plasma-arc2-distance.out'),
+            arc3_distance=hal.get_value('qtpyvcp.plasma-arc3-distance.out'),
+            leadin_radius=hal.get_value('qtpyvcp.plasma-leadin-radius.out'),
+            kerf_width=hal.get_value('qtpyvcp.param-kirfwidth.out'),
+            torch_off_distance_before_zero=hal.get_value('qtpyvcp.plasma-torch-off-distance.out'),
+            small_hole_detect=small_hole_detect,
+            small_hole_size=hal.get_value('qtpyvcp.plasma-small-hole-threshold.out') if small_hole_detect else 0,
+            marking_delay=hal.get_value('qtpyvcp.spot-delay.out'))
+
+
+    def flag_holes(self):
+        if self._hal is None:
+            self._load_hal_params()
+        h = self._hal
+
+        # only G3 lines can be holes, so just visit those. Lines can peek
+        # forward or back of the current record being processed.
+        parsed = self._parsed
+        lastx = lasty = None
+        for i in self._g3_lines:
+            line = parsed[i]
+            p = line.params
+            # this could be a hole, test for it.
+            # NB: Only circles that are defined as cww are deemed to be
+            # a hole.  cw (G2) cuts are deemed as an outer edge not inner.
+                                
+            #[1] find the last X and Y position while grp 1 was a motion code
+            need_x = need_y = True
+            for j in range(i-1, -1, -1):
+                prev = parsed[j]
+                if prev.active_g_modal_groups.get(1) not in _MOTION_CODES:
+                    continue
+                # is there an X or Y in the line
+                prev_p = prev.params
+                if need_x and 'X' in prev_p:
+                    lastx = prev_p['X']
+                    need_x = False
+                if need_y and 'Y' in prev_p:
+                    lasty = prev_p['Y']
+                    need_y = False
+                if not (need_x or need_y):
+                    break
+            endx = p.get('X', lastx)
+            endy = p.get('Y', lasty)
+            if endx is None or endy is None:
+                # no start position known so can't be treated as a hole
+                line.is_hole = False
+                continue
+            if endx == lastx and endy == lasty:
+                line.is_hole = True
+            else:
+                line.is_hole = False
+
+            # if line is a hole then prepare to replace
+            # with "smart" holes IF it is within the upper params of a
+            # hole definition.  Nomally <= 5 * thickness
+            if line.is_hole:
+                arc_i = p['I']
+                arc_j = p['J']
+                centre_x = endx + arc_i
+                centre_y = endy + arc_j
+                radius = HoleBuilder.line_length(centre_x, centre_y,endx, endy)
+                diameter = 2 * radius
+                circumferance = diameter * _PI
+                
+                # see if can find hidef data for this hole scenario
+                hidef_data = PLASMADB.hidef_holes(self.active_machineid, self.active_materialid, self.active_thicknessid)
+                hidef = False
+                if len(hidef_data) > 0:
+                    # leadinradius
+                    # kerf
+                    # cutheight
+                    # speed1
+                    # speed2
+                    # speed2dist
+                    # offdistance
+                    # overcut
+                    hidef_hole = HiDefHole(hidef_data)
+                    hidef_values = hidef_hole.get_all(diameter)
+                    if hidef_values is not None:
+                        hidef_leadin, hidef_kerf, \
+                            hidef_cutheight, hidef_speed1, \
+                            hidef_speed2, hidef_speed2dist, \
+                            hidef_offdistance, hidef_overcut = hidef_values
+                        hidef = True
+                
+                if diameter < h.small_hole_size and h.small_hole_detect:
+                    # removde the hole and replace with a pulse
+                    line.hole_builder = HoleBuilder()
+                    line.hole_builder.\
+                        plasma_mark(line, centre_x, centre_y, h.marking_delay)
+                    # scan forward and back to mark the M3 and M5 as Coammands.REMOVE
+                    self._mark_m3_m5_removal(i)
+                elif hidef:
+                    arc1_distance = circumferance - hidef_speed2dist - hidef_offdistance
+                    arc2_from_zero = arc1_distance + hidef_speed2dist
+                    arc3_from_zero = arc2_from_zero + hidef_overcut - circumferance
+                    line.hole_builder = HoleBuilder()
+                    line.hole_builder.\
+                        plasma_hole(line, centre_x, centre_y, diameter, \
+                                    hidef_kerf, hidef_leadin, \
+                                    [arc1_distance, \
+                                     arc2_from_zero, \
+                                     arc3_from_zero], hidef)
+                    
+                    # scan forward and back to mark the M3 and M5 as Coammands.REMOVE
+                    self._mark_m3_m5_removal(i)
+                elif (diameter <= self.active_thickness * h.thickness_ratio) or \
+                   (diameter <= h.max_hole_size):
+                    # Only build the hole of within a certain size of
+                    # Params:
+                    # x:              Hole Centre X position
+                    # y:              Hole Centre y position
+                    # d:              Hole diameter
+                    # kerf:           Kerf width for cut
+                    # leadin_radius:  Radius for the lead in arc
+                    # splits[]:       List of length segments. Segments will support different speeds. +ve is left of 12 o'clock
+                    #                 -ve is right of 12 o'clock
+                    #                 and starting positions of the circle. Including overburn
+                    if h.leadin_radius == 0:
+                        this_hole_leadin_radius = radius-(radius/4)-(h.kerf_width/2)
                     else:
-                        line.is_hole = False
-
-                    # if line is a hole then prepare to replace
-                    # with "smart" holes IF it is within the upper params of a
-                    # hole definition.  Nomally <= 5 * thickness
-                    if line.is_hole:
-                        line.hole_builder = HoleBuilder()
-                        arc_i = line.params['I']
-                        arc_j = line.params['J']
-                        centre_x = endx + arc_i
-                        centre_y = endy + arc_j
-                        radius = line.hole_builder.line_length(centre_x, centre_y,endx, endy)
-                        diameter = 2 * math.fabs(radius)
-                        circumferance = diameter * math.pi
-                        
-                        # see if can find hidef data for this hole scenario
-                        hidef_data = PLASMADB.hidef_holes(self.active_machineid, self.active_materialid, self.active_thicknessid)
-                        hidef = False
-                        if len(hidef_data) > 0:
-                            # leadinradius
-                            # kerf
-                            # cutheight
-                            # speed1
-                            # speed2
-                            # speed2dist
-                            # offdistance
-                            # overcut
-                            hidef_hole = HiDefHole(hidef_data)
-                            hidef_leadin = hidef_hole.leadin_radius(diameter)
-                            hidef_kerf = hidef_hole.kerf(diameter)
-                            hidef_cutheight = hidef_hole.cut_height(diameter)
-                            hidef_speed1 = hidef_hole.speed1(diameter)
-                            hidef_speed2 = hidef_hole.speed2(diameter)
-                            hidef_speed2dist = hidef_hole.speed2_distance(diameter)
-                            hidef_offdistance = hidef_hole.plasma_off_distance(diameter)
-                            hidef_overcut = hidef_hole.overcut(diameter)
-                            if None not in (hidef_leadin, hidef_kerf, \
-                                            hidef_cutheight, hidef_speed1, \
-                                            hidef_speed2, hidef_speed2dist, \
-                                            hidef_offdistance, hidef_overcut):
-                                hidef = True
+                        this_hole_leadin_radius = h.leadin_radius
                         
-                        if diameter < small_hole_size and small_hole_detect:
-                            # removde the hole and replace with a pulse
-                            line.hole_builder.\
-                                plasma_mark(line, centre_x, centre_y, marking_delay)
-                            # scan forward and back to mark the M3 and M5 as Coammands.REMOVE
-                            j = i-1
-                            found_m3 = False
-                            for j in range(j, -1, -1):
-                                prev = self._parsed[j]
-                                # mark for removal any lines until find the M3
-                                if prev.token.startswith('M3'):
-                                    found_m3 = True
-                                    prev.type = Commands.REMOVE
-                                if not found_m3:
-                                    prev.type = Commands.REMOVE
-                                try:
-                                    if prev.active_g_modal_groups[1] != 'G0' and found_m3:
-                                        break
-                                    elif prev.active_g_modal_groups[1] == 'G0':
-                                        prev.type = Commands.REMOVE
-                                except KeyError:
-                                    # access to the dictionary index failed,
-                                    # so no longer in a g0 mode
-                                    break
-                            j = i+1
-                            for j in range(j, len(self._parsed)):
-                                next = self._parsed[j]
-                                # mark all lines for removal until find M5
-                                next.type = Commands.REMOVE
-                                if next.token.startswith('M5'):
-                                    next.type = Commands.REMOVE
-                                    break
-                        elif hidef:
-                            arc1_distance = circumferance - hidef_speed2dist - hidef_offdistance
-                            arc2_from_zero = arc1_distance + hidef_speed2dist
-                            arc3_from_zero = arc2_from_zero + hidef_overcut - circumferance
-                            line.hole_builder.\
-                                plasma_hole(line, centre_x, centre_y, diameter, \
-                                            hidef_kerf, hidef_leadin, \
-                                            [arc1_distance, \
-                                             arc2_from_zero, \
-                                             arc3_from_zero], hidef)
-                            
-                            # scan forward and back to mark the M3 and M5 as Coammands.REMOVE
-                            j = i-1
-                            found_m3 = False
-                            for j in range(j, -1, -1):
-                                prev = self._parsed[j]
-                                # mark for removal any lines until find the M3
-                                if prev.token.startswith('M3'):
-                                    found_m3 = True
-                                    prev.type = Commands.REMOVE
-                                if not found_m3:
-                                    prev.type = Commands.REMOVE
-                                try:
-                                    if prev.active_g_modal_groups[1] != 'G0' and found_m3:
-                                        break
-                                    elif prev.active_g_modal_groups[1] == 'G0':
-                                        prev.type = Commands.REMOVE
-                                except KeyError:
-                                    # access to the dictionary index failed,
-                                    # so no longer in a g0 mode
-                                    break
-                            j = i+1
-                            for j in range(j, len(self._parsed)):
-                                next = self._parsed[j]
-                                # mark all lines for removal until find M5
-                                next.type = Commands.REMOVE
-                                if next.token.startswith('M5'):
-                                    next.type = Commands.REMOVE
-                                    break
-                            
-                        elif (diameter <= self.active_thickness * thickness_ratio) or \
-                           (diameter <= max_hole_size):
-                            # Only build the hole of within a certain size of
-                            # Params:
-                            # x:              Hole Centre X position
-                            # y:              Hole Centre y position
-                            # d:              Hole diameter
-                            # kerf:           Kerf width for cut
-                            # leadin_radius:  Radius for the lead in arc
-                            # splits[]:       List of length segments. Segments will support different speeds. +ve is left of 12 o'clock
-                            #                 -ve is right of 12 o'clock
-                            #                 and starting positions of the circle. Including overburn
-                            if leadin_radius == 0:
-                                this_hole_leadin_radius = radius-(radius/4)-(kerf_width/2)
-                            else:
-                                this_hole_leadin_radius = leadin_radius
-                                
-                            arc1_distance = circumferance - arc2_distance - torch_off_distance_before_zero
-                            arc2_from_zero = arc1_distance + arc2_distance
-                            arc3_from_zero = arc2_from_zero + arc3_distance - circumferance
-                            line.hole_builder.\
-                                plasma_hole(line, centre_x, centre_y, diameter, \
-                                            kerf_width, this_hole_leadin_radius, \
-                                            [arc1_distance, \
-                                             arc2_from_zero, \
-                                             arc3_from_zero])
-                            
-                            # scan forward and back to mark the M3 and M5 as Coammands.REMOVE
-                            j = i-1
-                            found_m3 = False
-                            for j in range(j, -1, -1):
-                                prev = self._parsed[j]
-                                # mark for removal any lines until find the M3
-                                if prev.token.startswith('M3'):
-                                    found_m3 = True
-                                    prev.type = Commands.REMOVE
-                                if not found_m3:
-                                    prev.type = Commands.REMOVE
-                                try:
-                                    if prev.active_g_modal_groups[1] != 'G0' and found_m3:
-                                        break
-                                    elif prev.active_g_modal_groups[1] == 'G0':
-                                        prev.type = Commands.REMOVE
-                                except KeyError:
-                                    # access to the dictionary index failed,
-                                    # so no longer in a g0 mode
-                                    break
-                            j = i+1
-                            for j in range(j, len(self._parsed)):
-                                next = self._parsed[j]
-                                # mark all lines for removal until find M5
-                                next.type = Commands.REMOVE
-                                if next.token.startswith('M5'):
-                                    next.type = Commands.REMOVE
-                                    break
-                        else:
-                            line.is_hole = False
-                            line.hole_builder = None
-            i += 1
+                    arc1_distance = circumferance - h.arc2_distance - h.torch_off_distance_before_zero
+                    arc2_from_zero = arc1_distance + h.arc2_distance
+                    arc3_from_zero = arc2_from_zero + h.arc3_distance - circumferance
+                    line.hole_builder = HoleBuilder()
+                    line.hole_builder.\
+                        plasma_hole(line, centre_x, centre_y, diameter, \
+                                    h.kerf_width, this_hole_leadin_radius, \
+                                    [arc1_distance, \
+                                     arc2_from_zero, \
+                                     arc3_from_zero])
+                    
+                    # scan forward and back to mark the M3 and M5 as Coammands.REMOVE
+                    self._mark_m3_m5_removal(i)
+                else:
+                    line.is_hole = False
 
     def flag_pierce(self):
         # old school loop so we can easily peek forward or back of the current
         # record being processed.
+        parsed = self._parsed
+        n = len(parsed)
         i = 0
-        while i < len(self._parsed):
-            line = self._parsed[i]
+        while i < n:
+            line = parsed[i]
             if len(line.command) == 2:
                 if line.command[0] == 'M' and line.command[1] == 3:
                     # this is a torce start so must be a pierce.
@@ -1228,12 +1253,12 @@ class PreProcessor:
                     # stuff in the moddle using Coammands.REMOVE
                     # Aadd in a wiggle for the pierce 
                     j = i+1
-                    for j in range(j, len(self._parsed)):
-                        next = self._parsed[j]
+                    for j in range(j, n):
+                        next = parsed[j]
                         # mark all lines for removal until find M5
-                        next.type = Commands.REMOVE
-                        if next.token.startswith('M5'):
-                            next.type = Commands.REMOVE
+                        next.type = _CMD_REMOVE
+                        if next.command == ('M', 5):
+                            next.type = _CMD_REMOVE
                             break
             i += 1
         
@@ -1246,42 +1271,62 @@ class PreProcessor:
         for line in self._orig_gcode:
             self._line_num += 1
             self._line = line.strip()
-            LOG.debug('Parse: Build gcode line.')
             l = CodeLine(self._line, parent=self)
-            try:
-                gcode = f'{l.command[0]}{l.command[1]}'
-            except:
-                gcode = ''
             self.set_active_g_modal(l.token)
-            l.save_g_modal_group(self.active_g_modal_grps)
+            if self._g_modal_snapshot is None:
+                self._g_modal_snapshot = self.active_g_modal_grps.copy()
+            l.save_g_modal_group(self._g_modal_snapshot)
+            # index the G3, M3 and M5 lines so holes can find them directly
+            if l.command == ('G', 3):
+                self._g3_lines.append(len(self._parsed))
+            elif l.command == ('M', 3):
+                self._m3_lines.append(len(self._parsed))
+            elif l.command == ('M', 5):
+                self._m5_lines.append(len(self._parsed))
             self._parsed.append(l)
+        # the raw lines are not needed once parsed
+        self._orig_gcode = None
+        LOG.debug(f'Parse: Built {self._line_num} gcode lines.')
+
 
 
+    def write_lines(self, out_lines):
+        # write a batch of output lines to stdout in one go. stdout's own
+        # buffer coalesces the batches, dump_parsed flushes once at the end
+        if out_lines:
+            sys.stdout.write('\n'.join(out_lines) + '\n')
+
 
     def dump_parsed(self):
         LOG.debug('Dump parsed gcode to stdio')
+        # output is collected and written in batches rather than
+        # printing and flushing each line
+        out_lines = []
         for l in self._parsed:
+            if len(out_lines) >= OUTPUT_BATCH_LINES:
+                self.write_lines(out_lines)
+                out_lines.clear()
             #print(f'{l.type}\t\t -- {l.command} \
             #    {l.params} {l.comment}')
             # build up line to go to stdout
             if l.is_hole:
-                print('(---- Smart Hole Start ----)')
-                l.hole_builder.generate_hole_gcode()
-                print('(---- Smart Hole End ----)')
-                print()
+                out_lines.append('(---- Smart Hole Start ----)')
+                l.hole_builder.generate_hole_gcode(out_lines)
+                out_lines.append('(---- Smart Hole End ----)')
+                out_lines.append('')
                 continue
             if l.is_pierce:
-                print('(---- Pierce ----)')
-                l.pierce_builder.generate_pierce_gcode(l)
+                out_lines.append('(---- Pierce ----)')
+                l.pierce_builder.generate_pierce_gcode(l, out_lines)
                 continue
-            if l.type is Commands.COMMENT:
+            if l.type is _CMD_COMMENT:
                 out = l.comment
-            elif l.type is Commands.OTHER:
+            elif l.type is _CMD_OTHER:
                 # Other at the moment means not recognised
                 out = "; >>  "+l.raw
-            elif l.type is Commands.PASSTHROUGH:
+            elif l.type is _CMD_PASSTHROUGH:
                 out = l.raw
-            elif l.type is Commands.REMOVE:
+            elif l.type is _CMD_REMOVE:
                 # skip line as not to be used
                 out = ''
                 continue
@@ -1297,8 +1342,9 @@ class PreProcessor:
                     out = out.strip()
                 except:
                     out = ''
-            print(out, file=sys.stdout)
-            sys.stdout.flush()
+            out_lines.append(out)
+        self.write_lines(out_lines)
+        sys.stdout.flush()
 
     def set_ui_hal_cutchart_pin(self):
         if self.active_cutchart is not None:
@@ -1338,6 +1384,7 @@ def main():
         # no connect string found OR can't connect so assume sqlite on local machine
         PLASMADB = PlasmaProcesses(db_type='sqlite')
         LOG.debug('Connected to SQLite DB')
+    _cached_cut_by_id.cache_clear()
 
     # Start cycling through each line of the file and processing it
     LOG.debug('Build preprocessor object and process gcode')
@@ -0,0 +1,162 @@
+"""Tests for the plasma gcode preprocessor filter.
+
+The filter runs inside LinuxCNC, so hal, linuxcnc and the plasma
+database plugin are replaced with stand-ins while the module is loaded.
+"""
+
+import contextlib
+import importlib.util
+import io
+import os
+import sys
+import tempfile
+import types
+import unittest
+from unittest import mock
+
+PREPROCESSOR_PATH = os.path.join(os.path.dirname(__file__), os.pardir,
+                                 'qtpyvcp', 'tools', 'plasma_gcode_preprocessor.py')
+
+
+def load_preprocessor(log_dir):
+    hal = types.ModuleType('hal')
+    hal.component = lambda name: None
+    hal.get_value = mock.Mock(side_effect=RuntimeError('no HAL pins in tests'))
+    hal.set_p = lambda pin, value: None
+
+    linuxcnc = types.ModuleType('linuxcnc')
+    linuxcnc.ini = lambda path: mock.Mock(find=lambda section, key: 'mm')
+
+    plasma_processes = types.ModuleType('qtpyvcp.plugins.plasma_processes')
+    plasma_processes.PlasmaProcesses = mock.Mock()
+    misc = types.ModuleType('qtpyvcp.utilities.misc')
+    misc.normalizePath = lambda path, base: os.path.join(log_dir, path)
+    config_loader = types.ModuleType('qtpyvcp.utilities.config_loader')
+    config_loader.load_config_files = lambda f: {}
+
+    stubs = {'hal': hal,
+             'linuxcnc': linuxcnc,
+             'qtpyvcp.plugins.plasma_processes': plasma_processes,
+             'qtpyvcp.utilities.misc': misc,
+             'qtpyvcp.utilities.config_loader': config_loader}
+    excepthook = sys.excepthook
+    with mock.patch.dict(sys.modules, stubs), \
+            mock.patch.dict(os.environ, {'INI_FILE_NAME': 'test.ini'}):
+        spec = importlib.util.spec_from_file_location('plasma_gcode_preprocessor',
+                                                      PREPROCESSOR_PATH)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    sys.excepthook = excepthook
+    return module
+
+
+class PreprocessorTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.TemporaryDirectory()
+        cls.pp = load_preprocessor(cls.tmp.name)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp.cleanup()
+
+    def preprocess(self, gcode):
+        path = os.path.join(self.tmp.name, 'test.ngc')
+        with open(path, 'w') as f:
+            f.write(gcode)
+        p = self.pp.PreProcessor(path)
+        p.parse()
+        return p
+
+    def dump(self, p):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            p.dump_parsed()
+        return out.getvalue().splitlines()
+
+
+class TorchOnOffMatchingTest(PreprocessorTestCase):
+
+    def test_m30_and_m52_are_not_torch_on_off(self):
+        p = self.preprocess('G21\n'
+                            'G0 X1 Y1\n'
+                            'M3 $0\n'
+                            'M52 P1\n'
+                            'G1 X2 Y2\n'
+                            'M5 $0\n'
+                            'M30\n')
+        self.assertEqual(p._m3_lines, [2])
+        self.assertEqual(p._m5_lines, [5])
+
+    def test_pierce_removal_runs_to_m5_past_m52(self):
+        p = self.preprocess('G21\n'
+                            'G90\n'
+                            'G0 X1 Y1\n'
+                            'M3 $0\n'
+                            'M52 P1\n'
+                            'G1 X2 Y2\n'
+                            'M5 $0\n'
+                            'G0 X5 Y5\n'
+                            'M30\n')
+        p.flag_pierce()
+        self.assertEqual(self.dump(p),
+                         ['G21',
+                          'G90',
+                          'G0 X1.0 Y1.0',
+                          '(---- Pierce ----)',
+                          'M3 $0',
+                          'G91',
+                          'G1 X0.0001',
+                          'G90',
+                          'M5 $0',
+                          'G0 X5.0 Y5.0',
+                          'M30'])
+
+
+# hole settings read by flag_holes
+HOLE_HAL_VALUES = {
+    'qtpyvcp.plasma-hole-thickness-ratio.out': 5.0,
+    'qtpyvcp.plasma-max-hole-size.out': 32.0,
+    'qtpyvcp.plasma-arc2-distance.out': 2.0,
+    'qtpyvcp.plasma-arc3-distance.out': 3.0,
+    'qtpyvcp.plasma-leadin-radius.out': 0.0,
+    'qtpyvcp.param-kirfwidth.out': 1.5,
+    'qtpyvcp.plasma-torch-off-distance.out': 1.0,
+    'qtpyvcp.plasma-small-hole-detect.checked': True,
+    'qtpyvcp.plasma-small-hole-threshold.out': 3.0,
+    'qtpyvcp.spot-delay.out': 0.1,
+}
+
+
+class FlagHolesTest(PreprocessorTestCase):
+
+    def flag_holes(self, gcode):
+        # returns the output with and without hole processing
+        plain = self.dump(self.preprocess(gcode))
+        p = self.preprocess(gcode)
+        with mock.patch.object(self.pp.hal, 'get_value',
+                               side_effect=HOLE_HAL_VALUES.__getitem__):
+            p.flag_holes()
+        return plain, self.dump(p)
+
+    def test_g3_without_start_position_is_not_a_hole(self):
+        plain, holes = self.flag_holes('G21\n'
+                                       'G90\n'
+                                       'M3 $0\n'
+                                       'G3 I0 J-2\n'
+                                       'M5 $0\n')
+        self.assertEqual(holes, plain)
+
+    def test_xy_before_any_motion_code_is_ignored(self):
+        plain, holes = self.flag_holes('G21\n'
+                                       'G90\n'
+                                       'X1 Y1\n'
+                                       'M3 $0\n'
+                                       'G3 X1 Y1 I0 J-2\n'
+                                       'M5 $0\n')
+        self.assertEqual(holes, plain)
+
+
+if __name__ == '__main__':
+    unittest.main()